@@ -21,19 +21,203 @@ import fts3.rest.client.easy as fts3
 import json
 import os
 import pika
+import pycurl
 import requests
+import threading
 import twisted
 
+from collections import deque
+from fts3.rest.client.exceptions import BadEndpoint, Unauthorized
 from os.path import basename
 from time import sleep
 from twisted.internet import reactor, threads
-from twisted.internet.defer import DeferredSemaphore, inlineCallbacks, \
-                                   returnValue
+from twisted.internet.defer import DeferredList, DeferredSemaphore, \
+                                   inlineCallbacks, returnValue
 from twisted.internet.task import LoopingCall
 from twisted.logger import Logger
 
 __author__ = "David Aikema, <david.aikema@uct.ac.za>"
 
+# Transfer queue messages are acknowledged in batches of up to this many
+# messages, or after this many seconds, whichever comes first
+_ACK_BATCH_SIZE = 16
+_ACK_FLUSH_INTERVAL = 1
+
+# Seconds to wait for the transfer agent to return the list of files to
+# transfer, so a hung agent can't hold a semaphore slot indefinitely
+_FILE_LIST_TIMEOUT = 60
+
+# Seconds to wait before returning a request which failed unexpectedly (e.g.
+# as the DB was unavailable) to the transfer queue to be retried
+_REQUEUE_DELAY = 30
+
+# Interval in seconds at which the FTS contexts are recreated, so that
+# renewed proxy certificates are picked up
+_FTS_CONTEXT_REFRESH_INTERVAL = 30 * 60
+
+# Errors after which the FTS contexts are discarded and recreated.  The
+# FTS client performs requests with pycurl, so transport and SSL failures
+# surface as pycurl errors unless it has wrapped them as BadEndpoint.
+_FTS_CONTEXT_ERRORS = (BadEndpoint, Unauthorized, pycurl.error)
+
+# The FTS client isn't thread-safe, so each worker thread making requests to
+# FTS keeps its own context here.  Contexts created before the current
+# generation are replaced before their next use.
+_fts_thread_local = threading.local()
+_fts_context_generation = 0
+
+# Maximum number of FTS job IDs per bulk status request, and maximum number
+# of these requests which may be in progress at once
+_STATUS_BATCH_SIZE = 50
+_STATUS_REQUESTS_MAX = 16
+
+# Maximum number of transfers whose FTS status is written to the DB by each
+# UPDATE statement, keeping the statements well within the server's maximum
+# packet size
+_STATUS_UPDATE_BATCH_SIZE = 50
+
+# While no transfers are in the TRANSFERRING state the FTS updater's polling
+# interval is doubled after each run, up to this many seconds.  It returns
+# to the configured interval as soon as a transfer is submitted to FTS.
+_IDLE_POLLING_INTERVAL_MAX = 300
+
+# Status given to transfers whose FTS job reaches one of these states.  The
+# status of transfers in any other state is left unchanged.
+_FTS_STATE_MAP = {'FINISHED': 'SUCCESS', 'FAILED': 'ERROR'}
+
+# SQL statements which are run repeatedly.  Each is defined once so that
+# every caller sends the DB the same statement.
+_SQL_SELECT_TRANSFERRING = ("SELECT transfer_id, fts_id FROM transfers "
+                            "WHERE status = 'TRANSFERRING'")
+_SQL_SET_TRANSFERRING = ("UPDATE transfers SET status = 'TRANSFERRING', "
+                         "fts_id = %s, fts_details = %s "
+                         "WHERE transfer_id = %s")
+_SQL_SET_ERROR = ("UPDATE transfers SET status = 'ERROR', "
+                  "extra_status = %s WHERE transfer_id = %s")
+
+
+def _encode_fts_details(fts_job_status):
+    """Serialize an FTS job status as compact JSON for the DB."""
+    return json.dumps(fts_job_status, separators=(',', ':'))
+
+
+def _build_fts_status_update(rows):
+    """Build a single UPDATE recording the FTS status of several transfers.
+
+    Argument:
+    rows -- list of [status, fts_details, transfer_id] for each transfer,
+      where a status of None leaves the status of the transfer unchanged
+
+    Return value:
+    A tuple of the SQL statement and its parameters
+    """
+    status_cases = []
+    status_params = []
+    details_cases = []
+    details_params = []
+    for status, fts_details, transfer_id in rows:
+        if status is not None:
+            status_cases.append('WHEN %s THEN %s')
+            status_params.extend([transfer_id, status])
+        details_cases.append('WHEN %s THEN %s')
+        details_params.extend([transfer_id, fts_details])
+
+    assignments = []
+    if status_cases:
+        assignments.append('status = CASE transfer_id %s ELSE status END'
+                           % ' '.join(status_cases))
+    assignments.append('fts_details = CASE transfer_id %s END'
+                       % ' '.join(details_cases))
+    sql = ('UPDATE transfers SET %s WHERE transfer_id IN (%s)'
+           % (', '.join(assignments), ', '.join(['%s'] * len(rows))))
+    return sql, status_params + details_params + [r[2] for r in rows]
+
+
+def _set_polling_interval(interval):
+    """Change the interval at which the FTS updater is run.
+
+    If this shortens the interval the next run is rescheduled accordingly.
+    """
+    global _fts_updater_runner
+
+    shorter = interval < _fts_updater_runner.interval
+    _fts_updater_runner.interval = interval
+    if shorter and _fts_updater_runner.running:
+        _fts_updater_runner.reset()
+
+
+def _call_fts(func, *args, **kwargs):
+    """Call an FTS client function with the current thread's FTS context.
+
+    This must be run in a worker thread (e.g. using deferToThread).  The
+    thread's context is created on first use and recreated whenever the
+    context generation has changed since.
+    """
+    global _fts_context_generation
+    global _fts_params
+    global _fts_thread_local
+
+    generation = _fts_context_generation
+    if getattr(_fts_thread_local, 'generation', None) != generation:
+        _fts_thread_local.context = fts3.Context(*_fts_params)
+        _fts_thread_local.generation = generation
+    return func(_fts_thread_local.context, *args, **kwargs)
+
+
+def _check_fts_context_error(e):
+    """Discard the FTS contexts if e indicates they are no longer valid."""
+    global _log
+    global _fts_context_generation
+
+    if isinstance(e, _FTS_CONTEXT_ERRORS):
+        _log.info('Discarding FTS contexts following error: %s' % e)
+        _fts_context_generation += 1
+
+
+def _refresh_fts_contexts():
+    """Have every thread recreate its FTS context before its next use."""
+    global _fts_context_generation
+
+    _fts_context_generation += 1
+
+
+@inlineCallbacks
+def _get_fts_job_statuses(fts_ids):
+    """Retrieve the FTS status of a list of jobs.
+
+    The job IDs are split into batches which are requested concurrently,
+    each in its own thread (with its own FTS context) as the FTS client is
+    blocking.  Batches which can't be retrieved are logged and left out of
+    the results.
+
+    Return value:
+    A dict mapping FTS job IDs to their status
+    """
+    global _log
+
+    sem = DeferredSemaphore(_STATUS_REQUESTS_MAX)
+    ds = []
+    for i in range(0, len(fts_ids), _STATUS_BATCH_SIZE):
+        ds.append(sem.run(threads.deferToThread, _call_fts,
+                          fts3.get_jobs_statuses,
+                          fts_ids[i:i + _STATUS_BATCH_SIZE],
+                          list_files=True))
+    results = yield DeferredList(ds, consumeErrors=True)
+
+    fts_job_statuses = {}
+    for success, result in results:
+        if not success:
+            _log.error('Error retrieving status of transfers from FTS')
+            _log.error(str(result.value))
+            _check_fts_context_error(result.value)
+            continue
+        # FTS returns a single status rather than a list when given one ID
+        if isinstance(result, dict):
+            result = [result]
+        for fts_job_status in result:
+            fts_job_statuses[fts_job_status['job_id']] = fts_job_status
+    returnValue(fts_job_statuses)
+
 
 # FTS Updater
 # (scans FTS server at a regular interval, updating the status of tasks)
@@ -42,103 +226,128 @@ def _FTSUpdater():
     """Contact FTS to update the status of transfers in TRANSFERRING state."""
     global _log
     global _dbpool
-    global _fts_params
+    global _fts_updater_runner
+    global _polling_interval
     global _sem_fts
+    global _fts_slot_holders
 
     _log.info("Running FTS updater")
 
-    # Initialize FTS context
+    # Retrieve list of transfers currently submitted to FTS from DB
     try:
-        fts_context = fts3.Context(*_fts_params)
+        r = yield _dbpool.runQuery(_SQL_SELECT_TRANSFERRING)
     except Exception, e:
-        _log.error('Exception creating FTS context in _FTSUpdater')
+        _log.error('Error retrieving list of in transferring stage from DB')
         _log.error(str(e))
         returnValue(None)
 
-    # Retrieve list of transfers currently submitted to FTS from DB
+    if not r:
+        _log.debug('FTS Updater found no transfers in the transferring state')
+        _set_polling_interval(min(_fts_updater_runner.interval * 2,
+                                  max(_polling_interval,
+                                      _IDLE_POLLING_INTERVAL_MAX)))
+        returnValue(None)
+
+    # Poll at the normal rate while there are transfers to track.  This is
+    # also done when transfers are submitted, but a run whose query preceded
+    # that submission would otherwise have backed the interval off again.
+    _set_polling_interval(_polling_interval)
+
+    # Get the FTS status of all of these transfers
+    fts_job_statuses = yield _get_fts_job_statuses([t[1] for t in r])
+
+    # Work out the new status (if any) of each transfer
+    rows = []
+    completed = []
+    for transfer_id, fts_id in r:
+        if fts_id not in fts_job_statuses:
+            continue
+        fts_job_status = fts_job_statuses[fts_id]
+
+        status = _FTS_STATE_MAP.get(fts_job_status.get('job_state'))
+        if status == 'SUCCESS':
+            _log.info('Transfer %s successfully completed using FTS'
+                      % transfer_id)
+        elif status == 'ERROR':
+            _log.info('Transfer %s has failed during the transfer stage'
+                      % transfer_id)
+        if status is not None:
+            completed.append(transfer_id)
+
+        rows.append([status, _encode_fts_details(fts_job_status),
+                     transfer_id])
+
+    def _update_transfers(txn):
+        """Record the FTS status of all transfers in one transaction.
+
+        MySQLdb's executemany runs UPDATEs one row at a time, so each batch
+        of transfers is instead written with a single statement.  Batches
+        keep each statement well within the server's maximum packet size.
+        """
+        for i in range(0, len(rows), _STATUS_UPDATE_BATCH_SIZE):
+            txn.execute(*_build_fts_status_update(
+                rows[i:i + _STATUS_UPDATE_BATCH_SIZE]))
+
     try:
-        r = yield _dbpool.runQuery("SELECT transfer_id, fts_id FROM transfers "
-                                   "WHERE status='TRANSFERRING'")
+        yield _dbpool.runInteraction(_update_transfers)
     except Exception, e:
-        _log.error('Error retrieving list of in transferring stage from DB')
+        _log.error('Error updating status for transfers in FTS manager')
         _log.error(str(e))
         returnValue(None)
 
-    if r is None:
-        _log.debug('FTS Updater found no transfers in the transferring state')
-        returnValue(None)
+    # Allow another transfer to start for each one which has completed.
+    # Transfers submitted to FTS before the service was restarted don't
+    # hold a slot of the semaphore, so there's none to release for them.
+    for transfer_id in completed:
+        if transfer_id in _fts_slot_holders:
+            _fts_slot_holders.remove(transfer_id)
+            _sem_fts.release()
 
-    # for each transfer get FTS status
-    transfersUpdated = 0
-    for transfer in r:
-        try:
-            transfer_id = transfer[0]
-            fts_id = transfer[1]
-            fts_job_status = fts3.get_job_status(fts_context, fts_id,
-                                                 list_files=True)
-
-            # Compare and update
-            state = fts_job_status['job_state']
-
-            if state == 'FINISHED':
-                _log.info('Transfer %s successfully completed using FTS'
-                          % transfer_id)
-                yield _dbpool.runQuery("UPDATE transfers SET status = "
-                                       "'SUCCESS', fts_details = %s WHERE "
-                                       "transfer_id = %s",
-                                       [str(fts_job_status), transfer_id])
-                yield _sem_fts.release()
-                transfersUpdated += 1
-            elif state == 'FAILED':
-                _log.info('Transfer %s has failed during the transfer stage'
-                          % transfer_id)
-                yield _dbpool.runQuery("UPDATE transfers SET status = "
-                                       "'ERROR', fts_details = %s WHERE "
-                                       "transfer_id = %s",
-                                       [str(fts_job_status), transfer_id])
-                yield _sem_fts.release()
-                transfersUpdated += 1
-            else:
-                yield _dbpool.runQuery("UPDATE transfers SET fts_details = %s "
-                                       "WHERE transfer_id = %s",
-                                       [str(fts_job_status), transfer_id])
-                transfersUpdated += 1
-        except Exception, e:
-            _log.error('Error updating status for transfers in FTS manager')
-            _log.error(str(e))
-            returnValue(None)
+    transfersUpdated = len(rows)
     if transfersUpdated > 0:
         _log.debug('FTS Updater updated the status of %s transfers that were '
                    'in the TRANSFERRING state' % transfersUpdated)
 
 
+def _run_fts_updater():
+    """Run the FTS updater, logging rather than propagating any error.
+
+    An error propagated to the LoopingCall running the FTS updater would
+    stop it, and with it all further updates to the status of transfers.
+    """
+    global _log
+
+    def _log_error(f):
+        _log.error('Unexpected error in FTS updater')
+        _log.error(str(f.value))
+
+    return _FTSUpdater().addErrback(_log_error)
+
+
 @inlineCallbacks
 def _start_fts_transfer(transfer_id):
-    """Submit transfer request for transfer to FTS server and update DB."""
+    """Submit transfer request for transfer to FTS server and update DB.
+
+    The caller must have acquired a slot of the FTS semaphore.  This is kept
+    once the transfer is in the TRANSFERRING state, to be released by the FTS
+    updater when it completes, and released here if the transfer fails.
+    """
     global _log
     global _dbpool
-    global _fts_params
+    global _polling_interval
     global _prepare_creds
-
-    try:
-        fts_context = fts3.Context(*_fts_params)
-    except Exception, e:
-        _log.error('Exception creating FTS context in _start_fts_transfer')
-        _log.error(str(e))
-        ds = "Failed to create FTS context when setting up transfer"
-        _dbpool.runQuery("UPDATE transfers SET status='ERROR', "
-                         "extra_status = %s WHERE transfer_id = %s",
-                         [ds, transfer_id])
-        returnValue(None)
+    global _sem_fts
+    global _fts_slot_holders
 
     # Get information about the transfer from the database
     r = yield _dbpool.runQuery("SELECT stager_path, stager_hostname, "
                                "destination_path FROM transfers WHERE "
                                "transfer_id = %s",
                                [transfer_id])
-    if r is None:
+    if not r:
         _log.error('Invalid transfer_id %s received by FTS transfer service'
                    % transfer_id)
+        _sem_fts.release()
         returnValue(None)
 
     # Create the transfer request
@@ -154,7 +363,8 @@ def _start_fts_transfer(transfer_id):
     try:
         r = yield threads.deferToThread(requests.post, transfer_host,
                                         data={'dir': localpath},
-                                        cert=(_prepare_creds))
+                                        cert=(_prepare_creds),
+                                        timeout=_FILE_LIST_TIMEOUT)
         body = json.loads(r.text)
         if r.status_code != 200:
             raise Exception(body['msg'])
@@ -164,8 +374,9 @@ def _start_fts_transfer(transfer_id):
         _log.error('Error retrieving file list for transfer %s from %s'
                     % (transfer_id, transfer_host))
         _log.error(str(e))
-        _dbpool.runQuery("UPDATE transfers SET status='ERROR', extra_status = "
-                         "%s WHERE transfer_id = %s", [str(e), transfer_id])
+        _dbpool.runQuery(_SQL_SET_ERROR, [str(e), transfer_id])
+        _sem_fts.release()
+        returnValue(None)
 
     # Setup the list of transfers and submit to FTS
     try:
@@ -174,47 +385,61 @@ def _start_fts_transfer(transfer_id):
             transfers.append(fts3.new_transfer(src + '/' + file,
                                                dst + '/' + file))
 
+        # The FTS client is blocking so contact the server from a thread
         fts_job = fts3.new_job(transfers)
-        fts_id = fts3.submit(fts_context, fts_job)
-        fts_job_status = fts3.get_job_status(fts_context, fts_id,
-                                             list_files=True)
+        fts_id = yield threads.deferToThread(_call_fts, fts3.submit,
+                                             fts_job)
+        fts_job_status = yield threads.deferToThread(_call_fts,
+                                                     fts3.get_job_status,
+                                                     fts_id, list_files=True)
     except Exception, e:
         _log.error('Error submitting transfer %s to FTS' % transfer_id)
         _log.error(str(e))
+        _check_fts_context_error(e)
         ds = "Error submitting transfer to FTS"
-        _dbpool.runQuery("UPDATE transfers SET status='ERROR', extra_status = "
-                         "%s WHERE transfer_id = %s", [ds, transfer_id])
+        _dbpool.runQuery(_SQL_SET_ERROR, [ds, transfer_id])
+        _sem_fts.release()
         returnValue(None)
 
     # Update transfer status, add FTS ID & FTS status
     try:
-        yield _dbpool.runQuery("UPDATE transfers SET status='TRANSFERRING', "
-                               "fts_id = %s, "
-                               "fts_details = %s WHERE transfer_id = %s",
-                               [fts_id, str(fts_job_status), transfer_id])
+        yield _dbpool.runQuery(_SQL_SET_TRANSFERRING,
+                               [fts_id, _encode_fts_details(fts_job_status),
+                                transfer_id])
     except Exception, e:
         _log.error('Error updating status for transfer %s' % transfer_id)
         _log.error(str(e))
         ds = "Error updating transfer status following FTS submission"
-        _dbpool.runQuery("UPDATE transfers SET status='ERROR', extra_status "
-                         "= %s WHERE transfer_id = %s", [ds, transfer_id])
-
+        _dbpool.runQuery(_SQL_SET_ERROR, [ds, transfer_id])
+        _sem_fts.release()
         returnValue(None)
     _log.info('Transfer database updated; added FTS ID %s for transfer %s'
               % (fts_id, transfer_id))
+    _fts_slot_holders.add(transfer_id)
+
+    # Resume polling FTS at the normal rate now there's work to track
+    _set_polling_interval(_polling_interval)
 
 
 @inlineCallbacks
 def _transfer_queue_listener():
     """Wait for requests to come in via transfer queue.
 
+    Requests are handled from callbacks as they arrive, starting the transfer
+    once the semaphore permits and acknowledging the request once the
+    transfer has been submitted to FTS or marked as failed.  Requests which
+    fail unexpectedly are returned to the queue after a delay, as retrying
+    them straight away would most likely fail again.
+
     Note that only a bounded number of transfers are permitted
     to be in the transferring state at any point in time and this is enforced
-    using a semaphore.
+    using a semaphore.  The prefetch count only controls how many requests
+    RabbitMQ buffers on this channel ahead of that semaphore.
     """
     global _log
     global _transfer_queue
     global _pika_conn
+    global _prefetch_count
     global _sem_fts
 
     channel = yield _pika_conn.channel()
@@ -222,22 +447,95 @@ def _transfer_queue_listener():
     queue = yield channel.queue_declare(queue=_transfer_queue,
                                         exclusive=False,
                                         durable=True)
-    yield channel.basic_qos(prefetch_count=1)
+    yield channel.basic_qos(prefetch_count=_prefetch_count)
+
+    # Acknowledge handled requests in batches.  The batch can't be larger
+    # than the prefetch count or RabbitMQ would stop delivering before it
+    # fills up.
+    ack_batch_size = min(_ACK_BATCH_SIZE, _prefetch_count)
+
+    # Delivery tags of unacknowledged requests in the order they arrived,
+    # and of those among them which have been handled
+    unacked = deque()
+    handled = set()
+
+    def _flush_acks():
+        """Acknowledge all handled requests.
+
+        Requests may finish out of order, and a multiple acknowledgement
+        covers every earlier delivery.  So a single basic_ack is only used
+        for the requests which arrived before the oldest one still being
+        handled; the rest are acknowledged individually, so that a slow
+        request can't hold up later ones until the prefetch limit stops
+        further deliveries.
+        """
+        last_tag = None
+        while unacked and unacked[0] in handled:
+            last_tag = unacked.popleft()
+            handled.remove(last_tag)
+        if last_tag is not None:
+            channel.basic_ack(delivery_tag=last_tag, multiple=True)
+
+        for delivery_tag in sorted(handled):
+            unacked.remove(delivery_tag)
+            channel.basic_ack(delivery_tag=delivery_tag, multiple=False)
+        handled.clear()
+
+    def _request_handled(delivery_tag):
+        """Note that a request has been handled and may be acknowledged."""
+        handled.add(delivery_tag)
+        if len(handled) >= ack_batch_size:
+            _flush_acks()
+
+    ack_flusher = LoopingCall(_flush_acks)
+    ack_flusher.start(_ACK_FLUSH_INTERVAL, now=False)
+    reactor.addSystemEventTrigger('before', 'shutdown', _flush_acks)
+
+    def _request_failed(f, delivery_tag, transfer_id):
+        """Requeue a failed request after a delay and free its slot.
+
+        The request remains unacknowledged until it is requeued, so it
+        still counts towards the prefetch limit in the meantime.
+        """
+        _log.error('Error starting transfer %s, returning it to the queue '
+                   'in %s seconds' % (transfer_id, _REQUEUE_DELAY))
+        _log.error(str(f.value))
+        _sem_fts.release()
+
+        def _requeue():
+            unacked.remove(delivery_tag)
+            if channel.is_open:
+                channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+
+        reactor.callLater(_REQUEUE_DELAY, _requeue)
+
+    def _handle_request(ch, method, properties, body):
+        """Start the transfer requested once the semaphore permits."""
+        delivery_tag = method.delivery_tag
+        unacked.append(delivery_tag)
+        if not body:
+            _request_handled(delivery_tag)
+            return
+        d = _sem_fts.acquire()
+        d.addCallback(lambda _: _start_fts_transfer(body))
+        d.addCallbacks(lambda _: _request_handled(delivery_tag),
+                       _request_failed, errbackArgs=(delivery_tag, body))
+
+    def _on_request(request):
+        """Handle a request along with any others already delivered."""
+        _handle_request(*request)
+        while queue.pending:
+            _handle_request(*queue.pending.pop(0))
+        queue.get().addCallback(_on_request)
 
-    # Enter loop
     queue, consumer_tag = yield channel.basic_consume(queue=_transfer_queue,
                                                       no_ack=False)
-
-    while True:
-        ch, method, properties, body = yield queue.get()
-        if body:
-            yield _sem_fts.acquire()
-            reactor.callFromThread(_start_fts_transfer, body)
-            yield ch.basic_ack(delivery_tag=method.delivery_tag)
+    queue.get().addCallback(_on_request)
 
 
 def init_fts_manager(pika_conn, dbpool, fts_params, transfer_queue,
-                     concurrent_max, polling_interval, prepare_creds):
+                     concurrent_max, polling_interval, prepare_creds,
+                     prefetch_count=None):
     """Initialize services to manage transfers using FTS.
 
     This involves:
@@ -245,14 +543,19 @@ def init_fts_manager(pika_conn, dbpool, fts_params, transfer_queue,
       transfers on the transfer queue
     * Scheduling a routine to run at a regular interval, querying the
       FTS server to update the status of transfers in the TRANSFERRING state.
+      This interval is backed off while no transfers are in that state.
+    * Scheduling the FTS contexts used by worker threads to contact the FTS
+      server to be recreated at a regular interval.
 
     Note that this function also initializes a semaphore used to enforce a
     limit on the maximum number of transfer tasks which are permitted to take
-    place in parallel.
+    place in parallel, and enlarges the reactor's thread pool so that
+    requests to the FTS server for each of these can be made in parallel.
 
     Parameters:
     pika_conn -- Global shared connection for RabbitMQ
-    dbpool -- Global shared database connection pool
+    dbpool -- Global shared database connection pool, which should allow
+      at least concurrent_max + 2 connections
     fts_params -- A list of parameters to initialize the FTS service
         [URI of FTS server, path to certificate, path to key]
     transfer_queue -- Name of the RabbitMQ queue to which to listen for
@@ -264,14 +567,20 @@ def init_fts_manager(pika_conn, dbpool, fts_params, transfer_queue,
       TRANSFERRING state
     prepare_creds -- A tuple containing filenames of a certificate and key
       used to authenticate with the transfer agent
+    prefetch_count -- Number of unacknowledged transfer requests RabbitMQ
+      may deliver ahead of time (default: min(concurrent_max, 100))
     """
     global _log
     global _dbpool
     global _fts_params
+    global _fts_updater_runner
     global _pika_conn
+    global _polling_interval
+    global _prefetch_count
     global _prepare_creds
     global _transfer_queue
     global _sem_fts
+    global _fts_slot_holders
 
     _log = Logger()
 
@@ -280,12 +589,25 @@ def init_fts_manager(pika_conn, dbpool, fts_params, transfer_queue,
     _fts_params = fts_params
     _prepare_creds = prepare_creds
     _transfer_queue = transfer_queue
+    _polling_interval = int(polling_interval)
     _sem_fts = DeferredSemaphore(int(concurrent_max))
+    _fts_slot_holders = set()
+
+    # Blocking FTS requests are made from the reactor's thread pool
+    reactor.suggestThreadPoolSize(int(concurrent_max) + _STATUS_REQUESTS_MAX)
+
+    if prefetch_count is None:
+        prefetch_count = min(int(concurrent_max), 100)
+    _prefetch_count = int(prefetch_count)
+
+    # Periodically replace the FTS contexts used by worker threads
+    fts_context_refresher = LoopingCall(_refresh_fts_contexts)
+    fts_context_refresher.start(_FTS_CONTEXT_REFRESH_INTERVAL, now=False)
 
     # Start queue listener
-    reactor.callFromThread(_transfer_queue_listener)
+    _transfer_queue_listener()
 
     # Run a task at a regular interval to update the status of
     # submitted transfers
-    fts_updater_runner = LoopingCall(_FTSUpdater)
-    fts_updater_runner.start(int(polling_interval))
+    _fts_updater_runner = LoopingCall(_run_fts_updater)
+    _fts_updater_runner.start(_polling_interval)
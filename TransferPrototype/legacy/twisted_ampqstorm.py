@@ -24,8 +24,6 @@ import getpass
 import json
 import oauth2
 import os
-import random
-import string
 import sys
 import threading
 import time
@@ -64,7 +62,8 @@ def queueTransferRequest(request):
 
 def genAuthToken():
   token_len = int(configData.get('main', 'authtokenlen'))
-  return ''.join(random.choice(string.lowercase) for i in range(token_len))
+  # Hex encode enough random bytes for token_len characters
+  return os.urandom((token_len + 1) // 2).encode('hex')[:token_len]
 
 # @defer.inlineCallbacks
 @route ('/doneStaging')
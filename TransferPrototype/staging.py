@@ -19,11 +19,9 @@ from __future__ import print_function  # for python 2
 
 import json
 import pika
-import random
 import requests
 import twisted
 
-from string import lowercase
 from sys import stderr
 from twisted.internet import defer, reactor, threads
 from twisted.internet.defer import DeferredSemaphore, inlineCallbacks, \
@@ -81,12 +81,17 @@ def main():
     configData = ConfigParser.ConfigParser()
     configData.read(cfg_file)
 
-    # Establish DB connection
+    # Establish DB connection, with enough connections in the pool for every
+    # transfer permitted to be in FTS at once plus the web interface
+    fts_concurrent_max = configData.get('fts', 'concurrent_max')
     dbpool = adbapi.ConnectionPool('MySQLdb',
                                    host=configData.get('mysql', 'hostname'),
                                    user=configData.get('mysql', 'username'),
                                    passwd=configData.get('mysql', 'password'),
-                                   db=configData.get('mysql', 'db'))
+                                   db=configData.get('mysql', 'db'),
+                                   cp_min=4,
+                                   cp_max=max(int(fts_concurrent_max) + 2, 10),
+                                   cp_reconnect=True)
     log.info("DB Connection Established")
 
     # Retrieve values needed for rabbit mq connections
@@ -135,7 +140,6 @@ def main():
                  prepare_callback)
 
     # Setup FTS manager
-    fts_concurrent_max = configData.get('fts', 'concurrent_max')
     fts_params = [
                   configData.get('fts', 'server'),  # URI of FTS service
                   configData.get('fts', 'cert'),  # cert
@@ -19,13 +19,12 @@ from __future__ import print_function  # for python 2
 
 import json
 import pika
-import random
-import string
 import uuid
 
-from pika import exceptions
+from pika import exceptions, spec
 from pika.adapters import twisted_connection
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import Deferred, DeferredLock, \
+                                   inlineCallbacks, returnValue
 from twisted.logger import Logger
 from twisted.web.resource import Resource
 from twisted.web.server import NOT_DONE_YET
@@ -35,6 +34,24 @@ from util import check_auth, match_against_allowed
 
 __author__ = "David Aikema, <david.aikema@uct.ac.za>"
 
+# Properties of the messages published to the staging queue.  These are
+# persistent so that queued transfers survive a RabbitMQ restart.
+_SEND_PROPERTIES = pika.BasicProperties(content_type='text/plain',
+                                        delivery_mode=2)
+
+# SQL statements run for transfer submissions.  The timestamp triggers only
+# fire on UPDATE, so time_submitted is set explicitly on insertion.  A
+# transfer is only marked as failed while still SUBMITTED, as one whose
+# publication wasn't confirmed may still have reached the staging queue and
+# been picked up by the staging manager.
+_SQL_ADD_SUBMITTED = ("INSERT INTO transfers (transfer_id, product_id, "
+                      "status, destination_path, submitter, "
+                      "prepare_activity, time_submitted) "
+                      "VALUES (%s, %s, 'SUBMITTED', %s, %s, %s, NOW())")
+_SQL_SET_SUBMIT_ERROR = ("UPDATE transfers SET status = 'ERROR', "
+                         "extra_status = %s WHERE transfer_id = %s "
+                         "AND status = 'SUBMITTED'")
+
 
 class SubmitException (Exception):
     """Track submit errors with option message and transfer ID.
@@ -76,11 +93,111 @@ class TransferSubmit (Resource):
         self._log = Logger()
         self._dbpool = dbpool
 
-        # Setup local connection to rabbitmq
+        # Setup local connection to rabbitmq.  The channel is opened when
+        # first needed and then shared by all requests.  Publisher confirms
+        # are enabled on it, with a Deferred for each unconfirmed message
+        # kept in _pending_confirms, keyed by delivery tag.
         self._staging_queue = staging_queue
         self._pika_conn = pika_conn
-        self._pika_bp = pika.BasicProperties(content_type='text/plain',
-                                             delivery_mode=1)
+        self._channel = None
+        self._channel_lock = DeferredLock()
+        self._delivery_tag = 0
+        self._pending_confirms = {}
+
+    @inlineCallbacks
+    def _get_channel(self):
+        """Return the shared RabbitMQ channel, opening it if necessary.
+
+        The staging queue is declared and publisher confirms are enabled
+        whenever a new channel is opened, which happens on first use and
+        after the previous channel has been closed.
+        """
+        yield self._channel_lock.acquire()
+        try:
+            if self._channel is None or not self._channel.is_open:
+                self._channel = None
+                channel = yield self._pika_conn.channel()
+                yield channel.queue_declare(queue=self._staging_queue,
+                                            exclusive=False, durable=True)
+
+                # Confirmations refer to the pending messages of this channel
+                # even once it's been replaced
+                pending = {}
+                returned = set()
+                channel.confirm_delivery(
+                    lambda frame: self._on_confirm(pending, returned, frame))
+                channel.add_on_return_callback(
+                    lambda ch, method, props, body: returned.add(body))
+                channel.add_on_close_callback(
+                    lambda *args: self._on_channel_closed(pending))
+
+                self._channel = channel
+                self._delivery_tag = 0
+                self._pending_confirms = pending
+        finally:
+            self._channel_lock.release()
+        returnValue(self._channel)
+
+    def _discard_channel(self):
+        """Close the shared channel, if still open, so a new one is opened."""
+        channel, self._channel = self._channel, None
+        if channel is not None and channel.is_open:
+            try:
+                channel.close()
+            except Exception, e:
+                self._log.error(e)
+
+    def _on_confirm(self, pending, returned, frame):
+        """Fire the Deferreds of messages acknowledged or rejected by RabbitMQ.
+
+        Arguments:
+        pending -- unconfirmed messages of the channel, keyed by delivery tag
+        returned -- bodies of messages which RabbitMQ couldn't route
+        frame -- the Basic.Ack or Basic.Nack frame received
+        """
+        method = frame.method
+        if method.multiple:
+            tags = sorted(t for t in pending if t <= method.delivery_tag)
+        else:
+            tags = [method.delivery_tag]
+
+        for tag in tags:
+            if tag not in pending:
+                continue
+            transfer_id, d = pending.pop(tag)
+            if isinstance(method, spec.Basic.Ack) and \
+                    transfer_id not in returned:
+                d.callback(None)
+            else:
+                returned.discard(transfer_id)
+                d.errback(SubmitException('RabbitMQ did not accept transfer',
+                                          transfer_id))
+
+    def _on_channel_closed(self, pending):
+        """Fail the messages which were still unconfirmed on a closed channel.
+
+        Argument:
+        pending -- unconfirmed messages of the channel, keyed by delivery tag
+        """
+        for tag in sorted(pending):
+            transfer_id, d = pending.pop(tag)
+            d.errback(SubmitException('RabbitMQ channel closed before '
+                                      'transfer was confirmed', transfer_id))
+
+    @inlineCallbacks
+    def _publish(self, transfer_id):
+        """Publish a transfer to the staging queue and wait for its confirm."""
+        channel = yield self._get_channel()
+        self._delivery_tag += 1
+        confirmed = Deferred()
+        self._pending_confirms[self._delivery_tag] = (transfer_id, confirmed)
+        try:
+            channel.basic_publish('', self._staging_queue, transfer_id,
+                                  _SEND_PROPERTIES, mandatory=True)
+        except Exception:
+            del self._pending_confirms[self._delivery_tag]
+            raise
+        yield confirmed
 
     def render_POST(self, request):
         """Manage POST request with transfer submission.
@@ -138,7 +255,7 @@ class TransferSubmit (Resource):
         if 'prepare' in request.args:
             prepare_activity = request.args['prepare'][0]
 
-        transfer_id = str(uuid.uuid1())
+        transfer_id = str(uuid.uuid4())
 
         def _add_initial(txn):
             """Create initial database record for transfer.
@@ -146,48 +263,52 @@ class TransferSubmit (Resource):
             Argument:
             txn --- database cursor
 
-            Note that the status of the record will be set to INIT until
-            the transfer has been successfully added to the RabbitMQ transfer
-            queue.
+            Note that the record is created in the SUBMITTED state, as it
+            must exist before the transfer is added to the RabbitMQ staging
+            queue.  If that fails the record is then set to ERROR.
             """
             try:
-                txn.execute("INSERT INTO transfers (transfer_id, product_id, "
-                            "status, destination_path, submitter, "
-                            "prepare_activity) VALUES (%s, %s, 'INIT', %s, "
-                            "%s, %s)", [transfer_id, product_id,
-                                        destination_path, x509dn,
-                                        prepare_activity])
+                txn.execute(_SQL_ADD_SUBMITTED, [transfer_id, product_id,
+                                                 destination_path, x509dn,
+                                                 prepare_activity])
             except Exception, e:
                 self._log.error(e)
                 request.setResponseCode(500)
                 raise SubmitException('Error creating database record',
                                       transfer_id)
 
+        def _set_error(txn, msg):
+            """Mark the transfer as failed unless it has been picked up.
+
+            Arguments:
+            txn --- database cursor
+            msg --- description of the error
+
+            Return value:
+            True if the transfer was marked as failed, False if it has
+            already moved on from the SUBMITTED state
+            """
+            txn.execute(_SQL_SET_SUBMIT_ERROR, [msg, transfer_id])
+            return txn.rowcount > 0
+
         # Add to rabbitmq
         @inlineCallbacks
         def _add_to_rabbitmq(_):
-            """Add the transfer to RabbitMQ."""
-            channel = yield self._pika_conn.channel()
-            yield channel.queue_declare(queue=self._staging_queue,
-                                        exclusive=False, durable=True)
-            yield channel.basic_publish('', self._staging_queue, transfer_id,
-                                        self._pika_bp)
-
-        def _update_status(txn):
-            """Update status of the transfer in the DB to SUBMITTED."""
+            """Add the transfer to RabbitMQ, marking it as failed if not."""
             try:
-                txn.execute("UPDATE transfers SET status = 'SUBMITTED' WHERE "
-                            "transfer_id = %s", [transfer_id])
+                yield self._publish(transfer_id)
             except Exception, e:
                 self._log.error(e)
-                request.setResponseCode(500)
-                msg = 'Error updating transfer status to STAGING'
-                result = {
-                  'msg': msg,
-                  'transfer_id': transfer_id,
-                  'error': True
-                }
-                return json.dumps(result) + "\n"
+                # Open a new channel for the next request unless RabbitMQ
+                # only rejected this particular message
+                if not isinstance(e, SubmitException):
+                    self._discard_channel()
+                msg = 'Error adding transfer to staging queue'
+                failed = yield self._dbpool.runInteraction(_set_error, msg)
+                if failed:
+                    raise SubmitException(msg, transfer_id)
+                self._log.info("Transfer %s was queued despite the error"
+                               % transfer_id)
 
         # Report results
         def _report_transfer_creation(_):
@@ -203,13 +324,13 @@ class TransferSubmit (Resource):
             self._log.info("Transfer submission of %s processed successfully"
                            % transfer_id)
 
-        def _handleCreationError(e):
+        def _handleCreationError(f):
             """Report that an error occured when processing the transfer."""
             request.setResponseCode(500)
-            if isinstance(e, SubmitException):
-                request.write(e.toJSON())
+            if f.check(SubmitException):
+                request.write(f.value.toJSON())
             else:
-                self._log.error(e)
+                self._log.error(str(f.value))
                 result = {
                   'msg': 'Unknown error handling transfer submission',
                   'transfer_id': transfer_id,
@@ -221,7 +342,6 @@ class TransferSubmit (Resource):
         # Add callbacks to handle the transfer submission asynchronously
         d = self._dbpool.runInteraction(_add_initial)
         d.addCallback(_add_to_rabbitmq)
-        d.addCallback(lambda _: self._dbpool.runInteraction(_update_status))
         d.addCallback(_report_transfer_creation)
         d.addErrback(_handleCreationError)
         return NOT_DONE_YET